@@ -0,0 +1,286 @@
+import os
+import copy
+import pickle
+import re
+import logging
+import threading
+import time
+import atexit
+from collections import OrderedDict
+from functools import lru_cache
+from datetime import date, timedelta
+from typing import Dict, Any, Optional, Set, Tuple, List
+
+from Voyagent.cache_manager import CACHE_DIR
+
+# The semantic tier of the query cache is optional
+try:
+    import faiss
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    faiss = None
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Query cache settings
+QUERY_CACHE_SIZE = 1024
+QUERY_CACHE_SAVE_INTERVAL = timedelta(minutes=1)
+SEMANTIC_SIMILARITY_THRESHOLD = 0.95
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+EMBEDDING_MEMO_SIZE = 256
+
+# Words that pin a query to particular dates; a semantic hit must agree on all of them
+_DATE_WORDS = frozenset([
+    "today", "tonight", "tomorrow", "yesterday", "this", "next", "last",
+    "weekend", "week", "month", "year",
+    "monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday",
+    "january", "february", "march", "april", "may", "june", "july", "august",
+    "september", "october", "november", "december",
+    "jan", "feb", "mar", "apr", "jun", "jul", "aug", "sep", "sept", "oct", "nov", "dec"
+])
+_TOKEN_RE = re.compile(r"[a-z]+|\d+")
+
+
+def _date_tokens(key: str) -> Set[str]:
+    """Return the numbers and date words in a normalized query."""
+    return {token for token in _TOKEN_RE.findall(key) if token.isdigit() or token in _DATE_WORDS}
+
+
+def _is_same_trip(key: str, cached_key: str, data: Dict[str, Any]) -> bool:
+    """
+    Check that a near-duplicate cached result also fits the new query.
+    
+    Embedding similarity does not separate swapped routes or different dates, so
+    the cached origin and destination must appear in the new query in the same
+    order, and both queries must mention the same numbers and date words.
+    
+    Args:
+        key: The normalized new query
+        cached_key: The normalized query the cached result was stored under
+        data: The cached structured data
+        
+    Returns:
+        True if the cached result can be returned for the new query
+    """
+    if _date_tokens(key) != _date_tokens(cached_key):
+        return False
+    
+    position = -1
+    for field in ("origin", "destination"):
+        place = str(data.get(field) or "").strip().lower()
+        if not place:
+            continue
+        found = key.find(place, position + 1)
+        if found < 0:
+            return False
+        position = found
+    return True
+
+
+class QueryCache:
+    """
+    A two-tier cache for structured query results.
+    
+    The first tier is an exact-match LRU keyed by the normalized query. The second
+    tier finds near-duplicate queries by embedding similarity and is only enabled
+    when faiss and sentence-transformers are installed. A near-duplicate is only
+    returned when its route and dates also fit the new query. Both tiers are persisted
+    to disk at most once per save interval and at exit, so that warm restarts keep
+    the cache without every miss paying for a rewrite. Entries are scoped to the current
+    day, since relative dates like "next weekend" resolve differently each day.
+    """
+    
+    def __init__(self, cache_dir=CACHE_DIR, max_size: int = QUERY_CACHE_SIZE,
+                 threshold: float = SEMANTIC_SIMILARITY_THRESHOLD):
+        """Initialize the cache and load any persisted entries."""
+        self.max_size = max_size
+        self.threshold = threshold
+        self._results_file = cache_dir / "preprocess_results.pkl"
+        self._index_file = cache_dir / "preprocess_index.faiss"
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._dirty = False
+        self._last_save = time.monotonic()
+        self._semantic_enabled = faiss is not None
+        self._encoder = None
+        self._encoder_lock = threading.Lock()
+        # A miss embeds the query in get() and again in put(), so remember recent embeddings
+        self._encode = lru_cache(maxsize=EMBEDDING_MEMO_SIZE)(self._encode_uncached)
+        self._reset(date.today().isoformat())
+        self._load()
+        atexit.register(self.flush)
+    
+    @staticmethod
+    def normalize(query: str) -> str:
+        """Normalize a query into its exact-match cache key."""
+        return query.strip().lower()
+    
+    def get(self, query: str) -> Optional[Dict[str, Any]]:
+        """
+        Look up a query in the cache.
+        
+        Args:
+            query: The original user query
+            
+        Returns:
+            A copy of the cached structured data, or None on a cache miss
+        """
+        key = self.normalize(query)
+        with self._lock:
+            self._expire_stale_day()
+            data = self._exact.get(key)
+            if data is not None:
+                self._exact.move_to_end(key)
+                logger.info(f"Query cache hit (exact): {query}")
+                return copy.deepcopy(data)
+            if self._index is None or self._index.ntotal == 0:
+                return None
+        
+        embedding = self._embed(key)
+        if embedding is None:
+            return None
+        
+        with self._lock:
+            if self._index is None or self._index.ntotal == 0:
+                return None
+            scores, ids = self._index.search(embedding, 1)
+            score, idx = float(scores[0][0]), int(ids[0][0])
+            if idx < 0 or score < self.threshold:
+                return None
+            cached_key, data = self._entries[idx]
+            if not _is_same_trip(key, cached_key, data):
+                logger.info(f"Rejected semantic query cache hit for a different trip: {query}")
+                return None
+            logger.info(f"Query cache hit (semantic, similarity {score:.3f}): {query}")
+            return copy.deepcopy(data)
+    
+    def put(self, query: str, data: Dict[str, Any]) -> None:
+        """
+        Store the structured data for a query in both cache tiers.
+        
+        Args:
+            query: The original user query
+            data: The structured data parsed from the Gemini response
+        """
+        key = self.normalize(query)
+        data = copy.deepcopy(data)
+        # The semantic tier stops accepting entries once full, so skip the embedding then
+        semantic_full = len(self._entries) >= self.max_size
+        embedding = None if semantic_full else self._embed(key)
+        
+        with self._lock:
+            self._expire_stale_day()
+            self._exact[key] = data
+            self._exact.move_to_end(key)
+            while len(self._exact) > self.max_size:
+                self._exact.popitem(last=False)
+            
+            if embedding is not None and len(self._entries) < self.max_size:
+                if self._index is None:
+                    self._index = faiss.IndexFlatIP(embedding.shape[1])
+                self._index.add(embedding)
+                self._entries.append((key, data))
+            
+            self._dirty = True
+            save_due = time.monotonic() - self._last_save >= QUERY_CACHE_SAVE_INTERVAL.total_seconds()
+        
+        if save_due:
+            self.flush()
+    
+    def flush(self) -> None:
+        """Persist the cache entries to disk if they changed since the last save."""
+        with self._save_lock:
+            # Snapshot under the lock, then write without blocking readers
+            with self._lock:
+                if not self._dirty:
+                    return
+                snapshot = {
+                    "day": self._day,
+                    "exact": list(self._exact.items()),
+                    "semantic": list(self._entries)
+                }
+                index_data = faiss.serialize_index(self._index) if self._index is not None else None
+                self._dirty = False
+                self._last_save = time.monotonic()
+            
+            if not self._write(snapshot, index_data):
+                with self._lock:
+                    self._dirty = True
+    
+    def _reset(self, day: str) -> None:
+        """Drop all entries and scope the cache to the given day."""
+        self._day = day
+        self._exact: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._entries: List[Tuple[str, Dict[str, Any]]] = []  # aligned with faiss ids
+        self._index = None
+    
+    def _expire_stale_day(self) -> None:
+        """Clear the cache when the day has changed since it was filled."""
+        today = date.today().isoformat()
+        if today != self._day:
+            logger.info("Clearing query cache from a previous day")
+            self._reset(today)
+    
+    def _embed(self, text: str):
+        """Embed a normalized query, or return None if the semantic tier is unavailable."""
+        if not self._semantic_enabled:
+            return None
+        try:
+            return self._encode(text)
+        except Exception as e:
+            logger.warning(f"Disabling semantic query cache: {e}")
+            self._semantic_enabled = False
+            return None
+    
+    def _encode_uncached(self, text: str):
+        """Encode a normalized query with the sentence-transformers model."""
+        if self._encoder is None:
+            # Concurrent first misses would otherwise each load the model
+            with self._encoder_lock:
+                if self._encoder is None:
+                    self._encoder = SentenceTransformer(EMBEDDING_MODEL)
+        embedding = np.asarray(self._encoder.encode([text], normalize_embeddings=True), dtype="float32")
+        # The array is shared through the memo, so guard it against mutation
+        embedding.setflags(write=False)
+        return embedding
+    
+    def _load(self) -> None:
+        """Load persisted cache entries from disk."""
+        if not self._results_file.exists():
+            return
+        try:
+            with open(self._results_file, "rb") as f:
+                saved = pickle.load(f)
+            if saved.get("day") != self._day:
+                return
+            self._exact.update(saved.get("exact", []))
+            if self._semantic_enabled and self._index_file.exists():
+                index = faiss.read_index(str(self._index_file))
+                entries = saved.get("semantic", [])
+                if index.ntotal == len(entries):
+                    self._index = index
+                    self._entries = entries
+            logger.info(f"Loaded {len(self._exact)} cached preprocessed queries")
+        except Exception as e:
+            logger.error(f"Error loading query cache: {e}")
+            self._reset(self._day)
+    
+    def _write(self, snapshot: Dict[str, Any], index_data) -> bool:
+        """Write a cache snapshot and the serialized faiss index to disk."""
+        try:
+            tmp_file = self._results_file.with_suffix(".tmp")
+            with open(tmp_file, "wb") as f:
+                pickle.dump(snapshot, f)
+            os.replace(tmp_file, self._results_file)
+            
+            if index_data is not None:
+                tmp_index = self._index_file.with_suffix(".tmp")
+                with open(tmp_index, "wb") as f:
+                    f.write(index_data.tobytes())
+                os.replace(tmp_index, self._index_file)
+            return True
+        except Exception as e:
+            logger.error(f"Error saving query cache: {e}")
+            return False
@@ -1,167 +1,579 @@
 import os
 import json
+import asyncio
+import copy
+import re
 import logging
-from typing import Dict, Any, Optional, Tuple
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, reduce
+from operator import or_
+from pathlib import Path
+from datetime import date, timedelta
+from typing import Dict, Any, Optional, Tuple, List
 from dotenv import load_dotenv
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
 
+from Voyagent.query_cache import QueryCache
+
+# orjson parses Gemini responses faster, with the stdlib json module as a fallback
+try:
+    import orjson
+    
+    _json_loads = orjson.loads
+    
+    def _json_dumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode()
+except ImportError:
+    _json_loads = json.loads
+    _json_dumps = json.dumps
+
 # Load environment variables
 load_dotenv()
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
+# Gemini model settings
+GEMINI_MODEL = "gemini-1.5-flash"
+
+# Enough for the compact JSON object; generation time grows with output length
+MAX_OUTPUT_TOKENS = 300
+
+# How long a caller waits on another caller's identical request before sending its own
+INFLIGHT_WAIT_TIMEOUT = 30.0
+
+# Static instructions describing the response schema
+_SCHEMA_SPEC = """You are a travel query analyzer that extracts structured information from natural language travel queries.
+Respond with a JSON object following the response schema:
+- query_type: flight search, place info (poi), directions, activity recommendations, general, or transport_comparison
+- origin: the origin location, or an empty string if not specified
+- destination: the destination location
+- date_info: start_date and end_date as YYYY-MM-DD and duration as a number of days, or empty strings
+- preferences: any additional preferences or constraints
+- structured_query: a reformatted version of the query optimized for search tools
+- transport_modes: only for transport_comparison queries
+
+If the query is about comparing different transportation methods (like "flights vs driving"),
+set query_type to "transport_comparison" and list the transport modes in transport_modes.
+"""
+
+_FEW_SHOT_EXAMPLES = """
+For example, if today were Friday, May 2, 2025, then given "I want to fly to Paris from New York next weekend", return:
+{"query_type": "flight", "origin": "New York", "destination": "Paris", "date_info": {"start_date": "2025-05-10", "end_date": "2025-05-11", "duration": "2"}, "preferences": [], "structured_query": "flights from New York to Paris departing May 10, 2025"}
+
+For "Should I drive or fly from San Francisco to Yosemite?", return:
+{"query_type": "transport_comparison", "origin": "San Francisco", "destination": "Yosemite", "date_info": {"start_date": "", "end_date": "", "duration": ""}, "preferences": [], "structured_query": "comparison of driving vs flying from San Francisco to Yosemite", "transport_modes": ["drive", "flight"]}
+"""
+
+# The static prompt; the date anchor changes daily and is appended per day
+_SYSTEM_PROMPT = _SCHEMA_SPEC + _FEW_SHOT_EXAMPLES
+
+
+def _date_anchor(today: date) -> str:
+    """
+    Describe today's date and the upcoming weekends for resolving relative dates.
+    
+    Args:
+        today: The current date
+        
+    Returns:
+        The date anchor appended to the system prompt
+    """
+    # On a Sunday, "this weekend" is the one in progress
+    if today.weekday() == 6:
+        this_saturday = today - timedelta(days=1)
+    else:
+        this_saturday = today + timedelta(days=5 - today.weekday())
+    next_saturday = this_saturday + timedelta(days=7)
+    
+    return (
+        f"Today's date is {today:%A, %B} {today.day}, {today.year} ({today.isoformat()}). "
+        f"Use this to calculate relative dates.\n"
+        f'For "tomorrow", use {(today + timedelta(days=1)).isoformat()}. '
+        f'For "this weekend", use {this_saturday.isoformat()} to {(this_saturday + timedelta(days=1)).isoformat()}. '
+        f'For "next weekend", use {next_saturday.isoformat()} to {(next_saturday + timedelta(days=1)).isoformat()}.\n'
+    )
+
+
+@lru_cache(maxsize=1)
+def _system_prompt(today: date) -> str:
+    """Build the system prompt anchored to the given date, once per day."""
+    return f"{_SYSTEM_PROMPT}\n{_date_anchor(today)}"
+
+
+@lru_cache(maxsize=1)
+def _system_message(today: date) -> SystemMessage:
+    """Build the system message reused by every request on the given date."""
+    return SystemMessage(content=_system_prompt(today))
+
+
+# Schema that pins Gemini's output to the JSON shape described in the system prompt
+# (upper-case type names, as expected by the Gemini Schema proto)
+TRAVEL_QUERY_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "query_type": {
+            "type": "STRING",
+            "enum": ["flight", "poi", "directions", "recommendations", "general", "transport_comparison"]
+        },
+        "origin": {"type": "STRING"},
+        "destination": {"type": "STRING"},
+        "date_info": {
+            "type": "OBJECT",
+            "properties": {
+                "start_date": {"type": "STRING"},
+                "end_date": {"type": "STRING"},
+                "duration": {"type": "STRING"}
+            },
+            "required": ["start_date", "end_date", "duration"]
+        },
+        "preferences": {"type": "ARRAY", "items": {"type": "STRING"}},
+        "structured_query": {"type": "STRING"},
+        "transport_modes": {
+            "type": "ARRAY",
+            "items": {"type": "STRING", "enum": ["flight", "drive", "bus", "train"]}
+        }
+    },
+    "required": ["query_type", "origin", "destination", "date_info", "preferences", "structured_query"]
+}
+
+# Passed on every request; langchain-google-genai 1.0.x only honours these per call
+_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": TRAVEL_QUERY_SCHEMA
+}
+
+# Bit flags for the keywords that mark a transport comparison query
+_VERSUS_BIT = 1
+_OR_BIT = 2
+_FLIGHT_BIT = 4
+_DRIVE_BIT = 8
+_TRAIN_BIT = 16
+_BUS_BIT = 32
+_TRANSPORT_MASK = _FLIGHT_BIT | _DRIVE_BIT | _TRAIN_BIT | _BUS_BIT
+
+_KEYWORD_BITS = {
+    "vs": _VERSUS_BIT,
+    "versus": _VERSUS_BIT,
+    "or": _OR_BIT,
+    "fly": _FLIGHT_BIT,
+    "flying": _FLIGHT_BIT,
+    "flight": _FLIGHT_BIT,
+    "flights": _FLIGHT_BIT,
+    "drive": _DRIVE_BIT,
+    "driving": _DRIVE_BIT,
+    "car": _DRIVE_BIT,
+    "cars": _DRIVE_BIT,
+    "train": _TRAIN_BIT,
+    "trains": _TRAIN_BIT,
+    "bus": _BUS_BIT,
+    "buses": _BUS_BIT
+}
+
+# Transport modes reported for each keyword bit, in output order
+_MODE_BITS = (
+    (_FLIGHT_BIT, "flight"),
+    (_DRIVE_BIT, "drive"),
+    (_TRAIN_BIT, "train"),
+    (_BUS_BIT, "bus")
+)
+_WORD_RE = re.compile(r"[a-z]+")
+
+# Matches JSON string literals, so that braces inside them are skipped, and braces
+_JSON_TOKEN_RE = re.compile(r'"(?:[^"\\]|\\.)*"|[{}]')
+
+
+def _extract_json_object(text: str) -> Optional[Dict[str, Any]]:
+    """
+    Find the first complete JSON object in a Gemini response.
+    
+    Each candidate opening brace is scanned forward until its braces balance, so prose
+    or markdown code fences around the object are ignored.
+    
+    Args:
+        text: The raw text of the Gemini response
+        
+    Returns:
+        The parsed object, or None if the response contains no valid JSON object
+    """
+    start = text.find("{")
+    while start >= 0:
+        depth = 0
+        for match in _JSON_TOKEN_RE.finditer(text, start):
+            token = match.group()
+            if token == "{":
+                depth += 1
+            elif token == "}":
+                depth -= 1
+                if depth == 0:
+                    try:
+                        data = _json_loads(text[start:match.end()])
+                    except ValueError:
+                        break
+                    if isinstance(data, dict):
+                        return data
+                    break
+        else:
+            # The object never closes, so any later brace is nested inside it
+            return None
+        start = text.find("{", start + 1)
+    return None
+
+
+# Curated city name to IATA airport code data
+AIRPORTS_FILE = Path(__file__).parent / "airports.json"
+
+
+def _load_city_to_iata() -> Dict[str, str]:
+    """Build the lowercase city name to IATA airport code map from airports.json."""
+    try:
+        with open(AIRPORTS_FILE, "r", encoding="utf-8") as f:
+            airports = json.load(f)
+    except (IOError, json.JSONDecodeError) as e:
+        logger.error(f"Error loading airport codes from {AIRPORTS_FILE}: {e}")
+        return {}
+    
+    city_to_iata = {city.lower(): iata for city, iata in airports.get("cities", {}).items()}
+    city_to_iata.update((alias.lower(), iata) for alias, iata in airports.get("aliases", {}).items())
+    return city_to_iata
+
+
+# City name to airport code map, built once at import
+CITY_TO_IATA = _load_city_to_iata()
+
 class GeminiPreprocessor:
     """
     A preprocessor that uses Gemini to structure natural language travel queries
     into formats that are better suited for various Apify tools.
     """
     
+    # The Gemini client is shared by every preprocessor in the process
+    _llm: Optional[ChatGoogleGenerativeAI] = None
+    _llm_lock = threading.Lock()
+    
+    # The query cache and in-flight requests are shared so that every caller benefits
+    _shared_query_cache: Optional[QueryCache] = None
+    _query_cache_lock = threading.Lock()
+    _inflight: Dict[str, threading.Event] = {}
+    _inflight_lock = threading.Lock()
+    
     def __init__(self):
         """Initialize the Gemini preprocessor."""
-        api_key = os.getenv("GOOGLE_API_KEY")
-        if api_key:
-            logger.info(f"Gemini API key loaded: {api_key[:8]}...")
-        else:
-            logger.error("Failed to load GOOGLE_API_KEY from environment")
+        self._query_cache = self._get_query_cache()
+    
+    @classmethod
+    def _get_query_cache(cls) -> QueryCache:
+        """Return the process-wide query cache, loading it from disk on first use."""
+        with cls._query_cache_lock:
+            if cls._shared_query_cache is None:
+                cls._shared_query_cache = QueryCache()
+        return cls._shared_query_cache
+    
+    @classmethod
+    def _get_llm(cls) -> ChatGoogleGenerativeAI:
+        """Return the shared Gemini client, creating it on first use."""
+        if cls._llm is None:
+            with cls._llm_lock:
+                if cls._llm is None:
+                    api_key = os.getenv("GOOGLE_API_KEY")
+                    if api_key:
+                        logger.info(f"Gemini API key loaded: {api_key[:8]}...")
+                    else:
+                        logger.error("Failed to load GOOGLE_API_KEY from environment")
+                    
+                    cls._llm = ChatGoogleGenerativeAI(
+                        model=GEMINI_MODEL,  # Using the latest Gemini model
+                        temperature=0,  # Keep it deterministic for structured outputs
+                        max_output_tokens=MAX_OUTPUT_TOKENS,
+                        google_api_key=api_key
+                    )
+        return cls._llm
+    
+    def _build_messages(self, query: str) -> List:
+        """Build the Gemini messages for a query."""
+        return [
+            _system_message(date.today()),
+            HumanMessage(content=query)
+        ]
+    
+    def _invoke(self, query: str) -> str:
+        """
+        Send a query to Gemini.
+        
+        Args:
+            query: The original user query
             
-        self.llm = ChatGoogleGenerativeAI(
-            model="gemini-1.5-flash",  # Using the latest Gemini model
-            temperature=0,  # Keep it deterministic for structured outputs
-            google_api_key=api_key
-        )
+        Returns:
+            The raw text of the Gemini response
+        """
+        return self._stream(self._get_llm(), self._build_messages(query))
     
-    def preprocess_query(self, query: str, context: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    async def _ainvoke(self, query: str) -> str:
+        """Async counterpart of _invoke."""
+        # Creating the client is blocking, so keep it off the event loop
+        llm = await asyncio.to_thread(self._get_llm)
+        return await self._astream(llm, self._build_messages(query))
+    
+    @staticmethod
+    def _stream(llm: ChatGoogleGenerativeAI, messages: List) -> str:
         """
-        Preprocess a natural language query into structured data for tools.
+        Stream a Gemini response to completion.
+        
+        The stream is never cut short, so LangChain callbacks see the end of the
+        generation and its usage metadata, and the text is parsed once afterwards.
+        
+        Args:
+            llm: The Gemini client
+            messages: The messages to send
+            
+        Returns:
+            The full response text
+        """
+        return "".join(chunk.content for chunk in llm.stream(messages, generation_config=_GENERATION_CONFIG))
+    
+    @staticmethod
+    async def _astream(llm: ChatGoogleGenerativeAI, messages: List) -> str:
+        """Async counterpart of _stream."""
+        parts = []
+        async for chunk in llm.astream(messages, generation_config=_GENERATION_CONFIG):
+            parts.append(chunk.content)
+        return "".join(parts)
+    
+    def _parse_response(self, query: str, result: str) -> Dict[str, Any]:
+        """
+        Extract the structured data from a Gemini response and cache it.
         
         Args:
             query: The original user query
-            context: Optional context from previous conversations
+            result: The raw text of the Gemini response
             
         Returns:
-            A dictionary containing structured data and metadata about the query
+            The structured data, or an error entry if no JSON was found
         """
-        logger.info(f"Preprocessing query with Gemini: {query}")
+        # Responses are pinned to JSON, so the envelope scan is only a fallback
+        try:
+            structured_data = _json_loads(result)
+        except ValueError:
+            structured_data = None
+        if not isinstance(structured_data, dict):
+            structured_data = _extract_json_object(result)
         
-        system_prompt = """You are a travel query analyzer that extracts structured information from natural language travel queries.
-        Your job is to parse the query and identify key components like:
-        
-        1. Query type (flight search, place info, directions, activity recommendations)
-        2. Origin location (for travel queries)
-        3. Destination location(s)
-        4. Date information (exact dates or relative periods like "next week")
-        5. Additional preferences or constraints
-        
-        Format your response as a JSON object with these fields:
-        {
-            "query_type": "flight" | "poi" | "directions" | "recommendations" | "general" | "transport_comparison",
-            "origin": "location name or empty string if not specified",
-            "destination": "location name",
-            "date_info": {
-                "start_date": "YYYY-MM-DD or empty string",
-                "end_date": "YYYY-MM-DD or empty string",
-                "duration": "number of days or empty string"
-            },
-            "preferences": ["list", "of", "preferences"],
-            "structured_query": "a reformatted version of the query optimized for search tools",
-            "transport_modes": ["flight", "drive", "bus", "train"] (only for transport_comparison queries)
-        }
+        if structured_data is not None:
+            self._query_cache.put(query, structured_data)
+        else:
+            structured_data = {"error": "Could not extract structured data"}
+            logger.error(f"Failed to extract JSON from Gemini response: {result}")
         
-        If the query is about comparing different transportation methods (like "flights vs driving"), 
-        set query_type to "transport_comparison" and list the transport modes in transport_modes array.
-
-        For airport codes, use standard airport codes like SFO for San Francisco or FAT for Fresno.
+        return structured_data
+    
+    def _postprocess(self, query: str, structured_data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Apply query-specific fixes to the structured data.
         
-        For example, given "I want to fly to Paris from New York next weekend", you would return:
-        {
-            "query_type": "flight",
-            "origin": "New York",
-            "destination": "Paris",
-            "date_info": {
-                "start_date": "2025-05-10", 
-                "end_date": "2025-05-12",
-                "duration": "2"
-            },
-            "preferences": [],
-            "structured_query": "flights from New York to Paris departing May 10, 2025"
-        }
+        Args:
+            query: The original user query
+            structured_data: The structured data from Gemini or the query cache
+            
+        Returns:
+            The structured data with the original query, comparison and airport code fixes
+        """
+        logger.info(f"Structured data: {_json_dumps(structured_data)}")
         
-        For "Should I drive or fly from San Francisco to Yosemite?", return:
-        {
-            "query_type": "transport_comparison",
-            "origin": "San Francisco",
-            "destination": "Yosemite",
-            "date_info": {"start_date": "", "end_date": "", "duration": ""},
-            "preferences": [],
-            "structured_query": "comparison of driving vs flying from San Francisco to Yosemite",
-            "transport_modes": ["drive", "flight"]
-        }
+        # Add original query to the response
+        structured_data["original_query"] = query
+        
+        # Special case handling for comparison queries
+        # str.lower() has an ASCII fast path and beats an ASCII-only str.translate table
+        q_tokens = set(_WORD_RE.findall(query.lower()))
+        bits = reduce(or_, (_KEYWORD_BITS[token] for token in q_tokens & _KEYWORD_BITS.keys()), 0)
+        transport_bits = bits & _TRANSPORT_MASK
+        if bits & _VERSUS_BIT:
+            is_comparison = bool(transport_bits)
+        else:
+            # "or" alone is too common ("fly to Paris or London?"), so it needs two distinct modes
+            is_comparison = bool(bits & _OR_BIT) and bool(transport_bits & (transport_bits - 1))
+        if is_comparison and structured_data.get("query_type") != "transport_comparison":
+            structured_data["query_type"] = "transport_comparison"
+            structured_data["transport_modes"] = [mode for bit, mode in _MODE_BITS if bits & bit]
         
-        Today's date is May 2, 2025. Use this to calculate relative dates.
-        For "this weekend", use May 3-4, 2025. For "next weekend", use May 10-11, 2025.
+        # Fix airport codes
+        if code := CITY_TO_IATA.get(structured_data.get("origin", "").lower()):
+            structured_data["origin_code"] = code
+        if code := CITY_TO_IATA.get(structured_data.get("destination", "").lower()):
+            structured_data["destination_code"] = code
+        
+        return structured_data
+    
+    def _fetch(self, query: str) -> Dict[str, Any]:
         """
+        Get the structured data for a query from Gemini.
         
-        messages = [
-            SystemMessage(content=system_prompt),
-            HumanMessage(content=query)
-        ]
+        Concurrent calls for the same query share one request: the first caller sends
+        it and the others wait for its result to land in the query cache, up to
+        INFLIGHT_WAIT_TIMEOUT seconds. Batch requests from _afetch share the same
+        registry.
+        
+        Args:
+            query: The original user query
+            
+        Returns:
+            The structured data parsed from the Gemini response
+        """
+        key = QueryCache.normalize(query)
+        with self._inflight_lock:
+            event = self._inflight.get(key)
+            is_leader = event is None
+            if is_leader:
+                event = self._inflight[key] = threading.Event()
+        
+        if not is_leader:
+            if event.wait(timeout=INFLIGHT_WAIT_TIMEOUT):
+                structured_data = self._query_cache.get(query)
+                if structured_data is not None:
+                    return structured_data
+            else:
+                logger.warning(f"Timed out waiting for an identical Gemini request, sending our own: {query}")
+            # The shared request failed or is stuck, so send our own
+            return self._parse_response(query, self._invoke(query))
         
         try:
-            # Get structured information from Gemini
-            result = self.llm.invoke(messages).content
+            return self._parse_response(query, self._invoke(query))
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+            event.set()
+    
+    async def _afetch(self, query: str, semaphore: asyncio.Semaphore) -> Dict[str, Any]:
+        """
+        Async counterpart of _fetch, used by the batch path.
+        
+        Args:
+            query: The original user query
+            semaphore: Bounds the number of Gemini requests the batch has in flight
             
-            # Extract JSON from the response if needed
-            json_start = result.find("{")
-            json_end = result.rfind("}") + 1
-            if json_start >= 0 and json_end > 0:
-                json_str = result[json_start:json_end]
-                structured_data = json.loads(json_str)
+        Returns:
+            The structured data parsed from the Gemini response
+        """
+        async def request() -> Dict[str, Any]:
+            async with semaphore:
+                result = await self._ainvoke(query)
+            # Parsing stores the result in the query cache, which embeds and may write to disk
+            return await asyncio.to_thread(self._parse_response, query, result)
+        
+        key = QueryCache.normalize(query)
+        with self._inflight_lock:
+            event = self._inflight.get(key)
+            is_leader = event is None
+            if is_leader:
+                event = self._inflight[key] = threading.Event()
+        
+        if not is_leader:
+            # The leader may be a synchronous caller, so wait for its event off the event loop
+            if await asyncio.to_thread(event.wait, INFLIGHT_WAIT_TIMEOUT):
+                structured_data = await asyncio.to_thread(self._query_cache.get, query)
+                if structured_data is not None:
+                    return structured_data
             else:
-                structured_data = {"error": "Could not extract structured data"}
-                logger.error(f"Failed to extract JSON from Gemini response: {result}")
-                
-            logger.info(f"Structured data: {json.dumps(structured_data)}")
+                logger.warning(f"Timed out waiting for an identical Gemini request, sending our own: {query}")
+            # The shared request failed or is stuck, so send our own
+            return await request()
+        
+        try:
+            return await request()
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+            event.set()
+    
+    def _error_response(self, query: str, error: Exception) -> Dict[str, Any]:
+        """Build the fallback response for a query that failed to preprocess."""
+        logger.error(f"Error preprocessing query with Gemini: {error}", exc_info=error)
+        return {
+            "error": str(error),
+            "original_query": query,
+            "query_type": "general"
+        }
+    
+    def preprocess_query(self, query: str, context: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Preprocess a natural language query into structured data for tools.
+        
+        Args:
+            query: The original user query
+            context: Optional context from previous conversations
             
-            # Add original query to the response
-            structured_data["original_query"] = query
+        Returns:
+            A dictionary containing structured data and metadata about the query
+        """
+        logger.info(f"Preprocessing query with Gemini: {query}")
+        
+        try:
+            # Identical or near-duplicate queries skip the Gemini call entirely
+            structured_data = self._query_cache.get(query)
+            if structured_data is None:
+                # Get structured information from Gemini
+                structured_data = self._fetch(query)
             
-            # Special case handling for comparison queries
-            if "vs" in query.lower() or "versus" in query.lower() or "or" in query.lower() and ("fly" in query.lower() or "drive" in query.lower()):
-                if structured_data.get("query_type") != "transport_comparison":
-                    structured_data["query_type"] = "transport_comparison"
-                    structured_data["transport_modes"] = []
-                    
-                    if "fly" in query.lower() or "flight" in query.lower():
-                        structured_data["transport_modes"].append("flight")
-                    if "drive" in query.lower() or "car" in query.lower():
-                        structured_data["transport_modes"].append("drive")
-                    if "train" in query.lower():
-                        structured_data["transport_modes"].append("train")
-                    if "bus" in query.lower():
-                        structured_data["transport_modes"].append("bus")
+            return self._postprocess(query, structured_data)
             
-            # Fix airport codes
-            if structured_data.get("origin", "").lower() in ["sf", "san francisco"]:
-                structured_data["origin_code"] = "SFO"
-            elif structured_data.get("origin", "").lower() in ["fresno", "fres"]:
-                structured_data["origin_code"] = "FAT"
-                
-            if structured_data.get("destination", "").lower() in ["fresno", "fres"]:
-                structured_data["destination_code"] = "FAT"
-            elif structured_data.get("destination", "").lower() in ["sf", "san francisco"]:
-                structured_data["destination_code"] = "SFO"
+        except Exception as e:
+            return self._error_response(query, e)
+    
+    async def preprocess_queries(self, queries: List[str], concurrency: int = 20) -> List[Dict[str, Any]]:
+        """
+        Preprocess many queries concurrently.
+        
+        Args:
+            queries: The original user queries
+            concurrency: The maximum number of Gemini requests in flight at once
             
-            return structured_data
+        Returns:
+            The structured data for each query, in the same order as the queries
+        """
+        logger.info(f"Preprocessing {len(queries)} queries with Gemini")
+        semaphore = asyncio.Semaphore(concurrency)
+        fetches: Dict[str, asyncio.Future] = {}
+        
+        async def preprocess(query: str) -> Dict[str, Any]:
+            # Cache hits return without taking a semaphore slot; lookups may embed the query
+            structured_data = await asyncio.to_thread(self._query_cache.get, query)
+            if structured_data is None:
+                # Duplicate queries in the batch share a single fetch, which in turn
+                # joins any identical request already in flight elsewhere in the process
+                key = QueryCache.normalize(query)
+                # No await between the check and the insert, so each key is fetched once
+                if key not in fetches:
+                    fetches[key] = asyncio.ensure_future(self._afetch(query, semaphore))
+                structured_data = copy.deepcopy(await fetches[key])
+            return self._postprocess(query, structured_data)
+        
+        results = await asyncio.gather(*(preprocess(query) for query in queries), return_exceptions=True)
+        return [
+            self._error_response(query, result) if isinstance(result, Exception) else result
+            for query, result in zip(queries, results)
+        ]
+    
+    def preprocess_queries_sync(self, queries: List[str], concurrency: int = 20) -> List[Dict[str, Any]]:
+        """
+        Preprocess many queries concurrently from synchronous code.
+        
+        Args:
+            queries: The original user queries
+            concurrency: The maximum number of Gemini requests in flight at once
             
-        except Exception as e:
-            logger.error(f"Error preprocessing query with Gemini: {e}", exc_info=True)
-            return {
-                "error": str(e),
-                "original_query": query,
-                "query_type": "general"
-            }
+        Returns:
+            The structured data for each query, in the same order as the queries
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.preprocess_queries(queries, concurrency))
+        
+        # Called from inside an event loop, so run the batch on its own loop in a worker thread
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(asyncio.run, self.preprocess_queries(queries, concurrency)).result()
         
     def extract_travel_info(self, query: str) -> Tuple[str, str, str]:
         """